@@ -4,105 +4,187 @@ these parts.  It extracts some textual properties, generates word clouds,
 performs topic modeling and writes information on this to an HTML file."""
 
 import os
+import math
+import re
 import argparse
 import logging
 import sys
+from html import escape
+from collections import Counter
+from operator import itemgetter
+from multiprocessing import Pool
 from wordcloud import WordCloud
-import matplotlib.pyplot as plt
+from wordcloud.wordcloud import FONT_PATH
+from PIL import Image, ImageDraw, ImageFont
+import numpy as np
 import matplotlib.colors as mcolors
-from nltk.tokenize import word_tokenize, sent_tokenize
-from dominate import document
-from dominate.tags import h1, ul, li, div, img, table, tr, th, td, style, attr
+import blingfire
 import gensim
 from gensim import corpora
 
+# Sentence final punctuation, optionally followed by closing quotes or
+# brackets, and then whitespace or the end of the text.  This is a heuristic
+# (e.g., abbreviations are counted as sentence ends).
+SENTENCE_END = re.compile(r"[.!?]+[\"'”’»)\]]*(?=\s|$)")
+# Whole words of letters (any alphabet, no digits or underscores).  As with
+# NLTK's tokenizer, a trailing clitic is split off and only the word before it
+# is kept ("don't" gives "do", "word's" gives "word"); other letter runs that
+# are joined to word characters by "-" or an apostrophe (e.g., "e-Mbabane")
+# are skipped rather than split into fragments
+LETTERS = re.compile(r"(?<!\w)(?<!\w[-'’])([^\W\d_]+)(?:n['’]t|['’](?:s|re|ve|ll|d|m))?"
+                     r"(?!\w)(?![-'’]\w)")
+
+
+def process_part(args):
+    """process_part computes the text properties of a single text/part.  args
+    is a tuple of the text and the set of stopwords.  It returns the number of
+    sentences, the number of tokens and the list of tokens with letters that
+    are not stopwords (lowercased)."""
+    text, stopwords = args
+    # The tokenizer separates the tokens by single spaces, so only the
+    # separators need to be counted (an empty text has no tokens); sentences
+    # are counted from their final punctuation
+    words = blingfire.text_to_words(text)
+    number_of_tokens = words.count(" ") + 1 if words else 0
+    number_of_sentences = len(SENTENCE_END.findall(text)) or 1
+    tokens_list = [w for w in LETTERS.findall(text.lower()) if w not in stopwords]
+    return number_of_sentences, number_of_tokens, tokens_list
+
 
 def identify_text_properties(data):
     """identify_text_properties counts the following properties from the parts:
         number of sentences, number of tokens and topkens per sentence.  It
-        also generates tokenized text for each of the parts.  This information
-        is stored in data["number of sentences"], data["number of tokens"],
-        data["tokens per sentence"], and data["tokenized_text"]."""
+        also generates the list of tokens for each of the parts.  This
+        information is stored in data["number of sentences"],
+        data["number of tokens"], data["tokens per sentence"] (NumPy arrays),
+        and data["tokens_list"].  The parts are processed in parallel.  Index
+        0 of each of these holds the information of the entire text,
+        aggregated from the parts (which start at index 1)."""
     logging.info("Computing text properties")
-    data["number of sentences"] = []
-    data["number of tokens"] = []
-    data["tokens per sentence"] = []
-    data["tokenized_text"] = []
-    for text in data["text"]:
-        tokenized_text = sent_tokenize(text)
-        data["number of sentences"].append(len(tokenized_text))
-        tokenized_text = word_tokenize(text)
-        data["number of tokens"].append(len(tokenized_text))
-        data["tokens per sentence"].append(
-                data["number of tokens"][-1]/data["number of sentences"][-1])
-        # keep only tokens with letters
-        tokenized_text = [w.lower() for w in tokenized_text if w.isalpha()]
-        tokenized_text = [w for w in tokenized_text if w not in data["stopwords"]]
-        joined_tokenized_text = " ".join(tokenized_text)
-        data["tokenized_text"].append(joined_tokenized_text)
+    # Identical parts are tokenized only once
+    unique_texts = list(dict.fromkeys(data["text"]))
+    with Pool(min(len(unique_texts), os.cpu_count() or 1)) as pool:
+        results = dict(zip(unique_texts, pool.map(process_part,
+                           [(text, data["stopwords"]) for text in unique_texts])))
+    number_of_sentences, number_of_tokens, tokens_lists = zip(
+            *[results[text] for text in data["text"]])
+    # The counts are stored as arrays; the counts of the entire text (index 0)
+    # are the sums over the parts
+    number_of_sentences = np.asarray(number_of_sentences, dtype = np.int64)
+    number_of_tokens = np.asarray(number_of_tokens, dtype = np.int64)
+    data["number of sentences"] = np.concatenate(
+            ([number_of_sentences.sum()], number_of_sentences))
+    data["number of tokens"] = np.concatenate(
+            ([number_of_tokens.sum()], number_of_tokens))
+    data["tokens per sentence"] = (data["number of tokens"] /
+                                   data["number of sentences"])
+    data["tokens_list"] = [[w for tokens_list in tokens_lists for w in tokens_list]]
+    data["tokens_list"].extend(tokens_lists)
     return data
 
 
+# WordCloud used by a word cloud worker process for all of its parts
+part_wordcloud = None
+
+
+def init_wordcloud_worker():
+    """init_wordcloud_worker creates the WordCloud that is reused for every
+    part that is drawn by this worker process."""
+    global part_wordcloud
+    part_wordcloud = WordCloud(background_color = "white", max_words = 5000,
+                               contour_width = 3, contour_color = "steelblue")
+
+
+def draw_part_wordcloud(args):
+    """draw_part_wordcloud generates a wordcloud of a single part.  args is a
+    tuple of the token frequencies of the part and the filename the image is
+    written to.  A part without tokens (e.g., an empty part or a part with
+    only stopwords) gets an empty (white) image."""
+    frequencies, filename = args
+    if not frequencies:
+        Image.new("RGB", (part_wordcloud.width, part_wordcloud.height),
+                  "white").save(filename)
+        return filename
+    part_wordcloud.generate_from_frequencies(frequencies)
+    part_wordcloud.to_file(filename)
+    return filename
+
+
 def generate_wordcloud(data):
     """generate_wordcloud generates a wordcloud as an image based on the
     content of the text in the text argument.  This image is stored in the
     output_dir (data["output_dir"] with the name of the part.png as the
-    filename."""
+    filename.  The wordclouds are generated in parallel."""
     data["wordcloud"] = []
     data["bases"] = []
     # We store the entire text on position 0
-    for counter in range(len(data["tokenized_text"])):
-        logging.info("Generating word cloud %s", counter)
+    for counter in range(len(data["tokens_list"])):
         if counter == 0:
             data["bases"].append("all")
         else:
             data["bases"].append(os.path.splitext(os.path.basename(data["input"][counter - 1]))[0])
-        wc = WordCloud(background_color = "white", max_words = 5000,
-                       contour_width = 3, contour_color = "steelblue")
-        wc.generate(data["tokenized_text"][counter])
-        plt.axis("off")
-        plt.imshow(wc)
         data["wordcloud"].append(data["bases"][-1] + ".png")
-        plt.savefig(data["output_dir"] + "/" + data["wordcloud"][-1], bbox_inches = "tight")
+    # The tokens are already cleaned, so the frequencies are given to the
+    # wordclouds directly; those of the entire text are summed from the parts
+    frequencies = [Counter(tokens_list) for tokens_list in data["tokens_list"][1:]]
+    total_frequencies = Counter()
+    for freqs in frequencies:
+        total_frequencies.update(freqs)
+    frequencies.insert(0, total_frequencies)
+    logging.info("Generating %s word clouds", len(data["wordcloud"]))
+    with Pool(min(len(frequencies), os.cpu_count() or 1),
+              initializer = init_wordcloud_worker) as pool:
+        pool.map(draw_part_wordcloud,
+                 [(freqs, data["output_dir"] + "/" + filename)
+                  for freqs, filename in zip(frequencies, data["wordcloud"])])
     return data
 
 
 def generate_lda(data):
     """generate_lda generates LDA clusters based on each of the parts.  This
     information is stored in data["lda_model"]."""
-    data["split_texts"] = [text.split() for text in data["tokenized_text"]]
+    data["split_texts"] = data["tokens_list"]
     data["id2word"] = corpora.Dictionary(data["split_texts"]) # Create dictionary
     data["corpus"] = [data["id2word"].doc2bow(text)
                       for text in data["split_texts"]] # Term Document Frequency
     # Build LDA model
     # Example of LDA model building:
     num_topics = 10
-    lda_model = gensim.models.ldamodel.LdaModel(corpus = data["corpus"],
-                                           id2word = data["id2word"],
-                                           num_topics = num_topics,
-                                           random_state = 100,
-                                           update_every = 1,
-                                           chunksize = 10,
-                                           passes = 10,
-                                           alpha = "symmetric",
-                                           iterations = 100,
-                                           per_word_topics = True)
+    # The E-step is spread over all but one of the cores (the master process
+    # performs the M-step), but each worker gets at least two documents
+    workers = max(1, min(len(data["corpus"]) // 2, (os.cpu_count() or 1) - 1))
+    # Each worker gets a single chunk of the documents, so each pass over the
+    # (small number of) parts is one E-step and one update of the model
+    chunksize = max(1, math.ceil(len(data["corpus"]) / workers))
+    lda_args = {"corpus": data["corpus"],
+                "id2word": data["id2word"],
+                "num_topics": num_topics,
+                "random_state": 100,
+                "chunksize": chunksize,
+                "passes": 10,
+                "alpha": "symmetric",
+                "iterations": 100,
+                "per_word_topics": False}
+    # A single worker process only adds overhead over training in the
+    # master process itself
+    if workers > 1:
+        lda_model = gensim.models.ldamulticore.LdaMulticore(workers = workers,
+                                                            **lda_args)
+    else:
+        lda_model = gensim.models.ldamodel.LdaModel(**lda_args)
     data["lda_model"] = lda_model
     return data
 
 
 def read_texts(data):
     """read_text reads in the contents of all the input files.  The contents is
-    stored in data["text"] where the 0th index is the concatenated text of the
-    parts (which start at index 1."""
+    stored in data["text"], one element per part (in the order of
+    data["input"])."""
     logging.info("Reading in texts")
-    data["text"] = [""]
+    data["text"] = []
     for ifile in data["input"]:
         with open(ifile, "r", encoding = "utf-8") as fp:
-            file_text = fp.readlines()
-        data["text"].append(" ".join(file_text))
-        # Add all text to first element of data["text"]
-        data["text"][0] += " ".join(file_text)
+            data["text"].append(fp.read())
     return data
 
 
@@ -114,118 +196,110 @@ def identify_most_influencial_topic(data):
     ldamodel = data["lda_model"]
     corpus = data["corpus"]
 
+    # The keywords of each topic are computed once, not once per document
+    topic_keywords = {k: ", ".join([word for word, prop in ldamodel.show_topic(k)])
+                      for k in range(ldamodel.num_topics)}
+
     # Get main topic in each document
     data["topic_doc"] = []
-    for _, row_list in enumerate(ldamodel[corpus]):
-        row = row_list[0] if ldamodel.per_word_topics else row_list
-        row = sorted(row, key = lambda x: (x[1]), reverse = True)
+    for bow in corpus:
         # Get the Dominant topic, Perc Contribution and Keywords for each document
-        for j, (topic_num, prop_topic) in enumerate(row):
-            if j == 0:  # => dominant topic
-                wp = ldamodel.show_topic(topic_num)
-                topic_keywords = ", ".join([word for word, prop in wp])
-                data["topic_doc"].append([int(topic_num), round(prop_topic,4), topic_keywords])
-            else:
-                break
+        row = ldamodel.get_document_topics(bow, minimum_probability = 0.0)
+        topic_num, prop_topic = max(row, key = itemgetter(1))
+        data["topic_doc"].append([int(topic_num), round(prop_topic,4),
+                                  topic_keywords[topic_num]])
     return data
 
 
-def generate_html_part(doc, data, part):
+def generate_html_part(data, part):
     """generate_html_part generates HTML for each of the texts/parts.  It
     writes information on hte number of sentences, number of tokens, and tokens
     per sentence, followed by the wordcloud of the part and information on the
-    most influencial topic for this part."""
+    most influencial topic for this part.  The HTML is returned as a
+    string."""
     logging.info("Generating part %s", part)
-    with doc:
-        h1(data["bases"][part])
-
-    with doc:
-        with ul():
-            attr(cls = "numbers")
-            for i in ["number of sentences", "number of tokens", "tokens per sentence"]:
-                li(f"{i}: {data[i][part]}")
-
-    with doc:
-        with div():
-            attr(cls = "wordcloud")
-            img(src = data["wordcloud"][part])
-    with doc:
-        with div():
-            attr(cls = "topic_doc")
-            with table():
-                with tr():
-                    th("topic")
-                    th("percentage")
-                    th("words")
-                with tr():
-                    for i in range(len(data["topic_doc"][part])):
-                        td(data["topic_doc"][part][i])
-    return doc
+    html = [f"<h1>{escape(data['bases'][part])}</h1>", '<ul class="numbers">']
+    for i in ["number of sentences", "number of tokens", "tokens per sentence"]:
+        html.append(f"<li>{escape(f'{i}: {data[i][part]}')}</li>")
+    html.append("</ul>")
+    html.append(f'<div class="wordcloud"><img src="{escape(data["wordcloud"][part])}"></div>')
+    html.append('<div class="topic_doc"><table>')
+    html.append("<tr><th>topic</th><th>percentage</th><th>words</th></tr>")
+    html.append("<tr>" + "".join(f"<td>{escape(str(value))}</td>"
+                                 for value in data["topic_doc"][part]) + "</tr>")
+    html.append("</table></div>")
+    return "\n".join(html)
+
+
+def single_color_func(color):
+    """single_color_func returns a color function for a WordCloud that colors
+    all words with color."""
+    return lambda *args, **kwargs: color
+
 
 def draw_topic_wordclouds(data):
     """draw_topic_wordclouds creates an image file in the output_dir with the
     filename that is stored in data["topic_cloud"].  The image file contains
-    wordclouds for each of the topics in the document."""
+    wordclouds for each of the topics in the document, tiled in two columns
+    with the topic number above each of the wordclouds."""
     cols = [color for name, color in mcolors.TABLEAU_COLORS.items()]
-    cloud = WordCloud(background_color = "white",
-                      width = 2500,
-                      height = 1800,
-                      max_words = 10,
-                      colormap = "tab10",
-                      color_func = lambda *args, **kwargs: cols[i],
-                      prefer_horizontal = 1.0)
+    width, height, title_height = 500, 360, 30
     topics = data["lda_model"].show_topics(formatted = False)
-    fig, axes = plt.subplots(5, 2, figsize = (10, 10), sharex = True, sharey = True)
-    for i, ax in enumerate(axes.flatten()):
-        fig.add_subplot(ax)
-        topic_words = dict(topics[i][1])
-        cloud.generate_from_frequencies(topic_words, max_font_size = 300)
-        plt.gca().imshow(cloud)
-        plt.gca().set_title("Topic " + str(i), fontdict = {"size": 16})
-        plt.gca().axis("off")
-
-    plt.subplots_adjust(wspace = 0, hspace = 0)
-    plt.axis("off")
-    plt.margins(x = 0, y = 0)
-    plt.tight_layout()
+    font = ImageFont.truetype(FONT_PATH, 16)
+    rows = (len(topics) + 1) // 2
+    grid = Image.new("RGB", (2 * width, rows * (height + title_height)), "white")
+    draw = ImageDraw.Draw(grid)
+    for i, (topic_num, topic_words) in enumerate(topics):
+        cloud = WordCloud(background_color = "white",
+                          width = width,
+                          height = height,
+                          max_words = 10,
+                          color_func = single_color_func(cols[i % len(cols)]),
+                          prefer_horizontal = 1.0)
+        cloud.generate_from_frequencies(dict(topic_words), max_font_size = 60)
+        x, y = (i % 2) * width, (i // 2) * (height + title_height)
+        draw.text((x + width // 2, y + title_height // 2), "Topic " + str(topic_num),
+                  fill = "black", font = font, anchor = "mm")
+        grid.paste(cloud.to_image(), (x, y + title_height))
+
     data["topic_cloud"] = "topic_cloud.png"
-    plt.savefig(data["output_dir"] + "/" + data["topic_cloud"], bbox_inches = "tight")
-#    plt.show()
+    grid.save(data["output_dir"] + "/" + data["topic_cloud"])
     return data
 
 
-def generate_html_summary(doc, data):
-    """generate_html_summary writes summary information of the document to doc.
+def generate_html_summary(data):
+    """generate_html_summary generates summary information of the document.
     At the moment, this is only an image of the wordclouds for the different
-    topics."""
+    topics.  The HTML is returned as a string."""
     # Write topic overview
-    with doc:
-        with div():
-            attr(cls = "topic_cloud")
-            img(src = data["topic_cloud"])
-    return doc
+    return f'<div class="topic_cloud"><img src="{escape(data["topic_cloud"])}"></div>'
 
 
 def generate_html(data):
     """generate_html generates an HTML file in data["output_dir"] + "/" +
     data["base"] + ".html" containing the results of the analyses."""
     logging.info("Generating HTML")
-    doc = document(title = f"Analysis of document: {data["base"]}")
-
-    with doc.head:
-        style("""
+    html = ["<!DOCTYPE html>",
+            "<html>",
+            "<head>",
+            f"<title>Analysis of document: {escape(data['base'])}</title>",
+            """<style>
         body {background-color: powderblue;}
         h1   {color: blue;}
         p    {color: red;}
-    """)
+    </style>""",
+            "</head>",
+            "<body>"]
 
     for counter in range(len(data["bases"])):
-        doc = generate_html_part(doc, data, counter)
+        html.append(generate_html_part(data, counter))
 
-    doc = generate_html_summary(doc, data)
+    html.append(generate_html_summary(data))
+    html.append("</body>")
+    html.append("</html>")
 
     with open(data["output_dir"] + "/" + data["base"] + ".html", "w", encoding = "utf-8") as fp:
-        fp.write(str(doc))
+        fp.write("\n".join(html))
 
 
 def main():
@@ -262,7 +336,7 @@ def main():
     except:
         logging.critical("Problem opening or reading from stopwords file")
         sys.exit()
-    data["stopwords"] = " ".join(stopwords).split()
+    data["stopwords"] = frozenset(" ".join(stopwords).split())
 
     # Create output directory if it does not exist
     data["output_dir"] = args.output_dir